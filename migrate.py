@@ -1,13 +1,13 @@
 import geopandas as gpd
+import numpy as np
 import pandas as pd
-import maup
 import us
 import os
+import re
 import typer
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
-from shapely import wkt
 import repair_gdf_jc_v1_2
-import tqdm
 import shapely
 
 import warnings; warnings.filterwarnings('ignore', 'GeoSeries.isna', UserWarning)
@@ -47,17 +47,25 @@ STATE_CRS_MAPPINGS = {
     "PA": "epsg:6562"
 }
 
+IO_ENGINE = "pyogrio" # batched Arrow/WKB reads and writes instead of Fiona's per-feature path
+
+ELECTION_COL_PREFIXES = ["SEN", "PRES", "GOV", "TRE", "AG", "LTGOV", "AUD", "USH", "SOS", "CAF", "SSEN", "STH", "TOTVOTE", "RGOV", "DGOV", "DPRES", "RPRES", "DSC", "RSC", "EL", "G16", "G17", "G18", "G20", "COMP", "ATG", "SH", "SP_SEN", "USS", "SOC", "BOSMAY", "SS08P", "SS13P", "LTG", "LG"]
+# One compiled prefix match per column; SEND and SENDIST are district ids, not elections
+ELECTION_COL_PATTERN = re.compile("(?!(?:SEND|SENDIST)$)(?:" + "|".join(ELECTION_COL_PREFIXES) + ")")
+
 def main(state_str: str, old_precinct_loc: str, vtd_loc = None, output_loc = None, driver = None, epsilon_range = (7, 10), export_blocks: bool = False, include_cvap: bool = False, repair: bool = False, drop_na: bool = False, ignore_top_issues: bool = False, accept_error: bool = False):
     state = us.states.lookup(state_str)
     crs = STATE_CRS_MAPPINGS[state_str]
-    blocks = gpd.read_file(f"/home/max/git/census-process/final/{state_str.lower()}/{state_str.lower()}_block.shp").to_crs(crs)
-    counties = gpd.read_file(f"/home/max/git/census-process/final/{state_str.lower()}/{state_str.lower()}_county.shp").to_crs(crs)
+    blocks_loc = f"/home/max/git/census-process/final/{state_str.lower()}/{state_str.lower()}_block.shp"
+    blocks = None # only read once a county actually needs them
+    counties = load_or_cache(f"/home/max/git/census-process/final/{state_str.lower()}/{state_str.lower()}_county.shp", crs)
 
     if not vtd_loc:
         vtd_loc = f"/home/max/git/census-process/final/{state_str.lower()}/{state_str.lower()}_vtd.shp"
-    vtds = gpd.read_file(vtd_loc).to_crs(crs)
+    vtds = load_or_cache(vtd_loc, crs)
 
-    old_precincts = gpd.read_file(old_precinct_loc).to_crs(crs)
+    old_precincts = gpd.read_file(old_precinct_loc, engine=IO_ENGINE)
+    old_precincts.to_crs(crs, inplace=True)
     # old_precincts["geometry"] = old_precincts["geometry"].apply(lambda x: wkt.loads(str(x)))
     old_precincts["geometry"] = old_precincts["geometry"].buffer(0)# .simplify()
     if drop_na:
@@ -70,37 +78,47 @@ def main(state_str: str, old_precinct_loc: str, vtd_loc = None, output_loc = Non
     old_precincts[election_cols] = old_precincts[election_cols].astype(float)
 
     # matches = close_matches(old_precincts, vtds)
-    combined_counties_vtds = []
+    vote_totals = np.zeros((len(vtds), len(election_cols))) # matched and transferred votes, summed per vtd
     # county_matched_vtds = close_matches(vtds, counties)
-    county_matched_vtds = maup.assign(vtds, counties)
+    county_matched_vtds = assign_units(vtds, counties)
     # county_matched_precincts = close_matches(old_precincts, counties)
     # breakpoint()
-    county_matched_precincts = maup.assign(old_precincts, counties)
+    county_matched_precincts = assign_units(old_precincts, counties)
+    block_assignment = None # blocks -> vtds never changes, so only assign once
+    block_votes = None # prorated votes, summed per block over every county
+
+    # Only carry the columns each step reads into the per-county subsets, rather than copying whole frames
+    vtd_geometries = vtds[["geometry"]]
+    precinct_votes = old_precincts[["geometry"] + election_cols]
     for county in set(county_matched_vtds.values):
-        county_vtds = vtds.iloc[[k for k, v in county_matched_vtds.items() if v==county]]
-        county_precincts = old_precincts.iloc[[k for k, v in county_matched_precincts.items() if v==county]]
+        county_vtds = vtd_geometries[(county_matched_vtds == county).to_numpy()]
+        county_precincts = precinct_votes[(county_matched_precincts == county).to_numpy()]
 
         matches = close_matches(county_vtds, county_precincts, reverse=True, ignore_top_issues = ignore_top_issues)
-        matched_vtds = county_vtds.loc[matches].copy()
         # unmatched_vtds = vtds.iloc[list(set(vtds.index) - set(matches))].copy()
-        matched_precincts = county_precincts.loc[matches.index].copy()
-        unmatched_precincts = county_precincts.loc[list(set(county_precincts.index) - set(matches.index))].copy()
+        unmatched_precincts = county_precincts[~county_precincts.index.isin(matches.index)]
         print("County:", county, "Number of matches:", len(matches), "unmatched:", len(unmatched_precincts))
 
-        matched_precincts["matches"] = matches
-        matched_vtds[election_cols] = matched_precincts.set_index("matches")[election_cols]
-        print("Sum of absolute vote error on matched vtds", abs(matched_precincts[election_cols].sum() - matched_vtds[election_cols].sum()).sum())
+        # Matched vtds take their precinct's votes as is: one positional gather and one scatter
+        matched_votes = county_precincts[election_cols].to_numpy(dtype=float)[county_precincts.index.get_indexer(matches.index)]
+        np.add.at(vote_totals, vtds.index.get_indexer(matches.to_numpy()), np.nan_to_num(matched_votes))
         # matched_vtds[election_cols] = matches.map(matched_precincts[election_cols])
         # unmatched_vtds = transfer_votes(unmatched_precincts, unmatched_vtds, blocks, election_cols, scaling = "VAP20", verbose = True)
         if len(unmatched_precincts):
-            unmatched_vtds = transfer_votes(unmatched_precincts, vtds, blocks, election_cols, scaling = "VAP20", verbose = True)# .iloc[list(set(vtds.index) - set(matches))].copy()
-            combined_counties_vtds.append(pd.concat([matched_vtds, unmatched_vtds]))
-        else:
-            combined_counties_vtds.append(matched_vtds)
-
-    combined_vtds = pd.concat(combined_counties_vtds)
+            if blocks is None:
+                blocks = load_or_cache(blocks_loc, crs)
+                block_units = blocks[["geometry", "VAP20"]]
+                block_votes = np.zeros((len(blocks), len(election_cols)))
+            if block_assignment is None:
+                block_assignment = assign_units(blocks, vtds)
+            # Blocks outside the unmatched precincts' bounding box can't pick up any of their votes
+            nearby = np.sort(blocks.sindex.query(shapely.box(*unmatched_precincts.total_bounds)))
+            nearby_blocks = block_units.iloc[nearby].copy()
+            unmatched_vtds = transfer_votes(unmatched_precincts, vtds, nearby_blocks, election_cols, scaling = "VAP20", verbose = True, assignment_to_target = block_assignment.iloc[nearby])# .iloc[list(set(vtds.index) - set(matches))].copy()
+            vote_totals += np.nan_to_num(unmatched_vtds[election_cols].to_numpy(dtype=float))
+            block_votes[nearby] += np.nan_to_num(nearby_blocks[election_cols].to_numpy(dtype=float))
 
-    vtds[election_cols] = combined_vtds[election_cols].groupby(combined_vtds.index).agg("sum")
+    vtds[election_cols] = vote_totals
 
     print(vtds)
     print(f"(final) Sum of absolute vote error on all vtds on {state_str}", abs(old_precincts[election_cols].sum() - vtds[election_cols].sum()).sum())
@@ -109,38 +127,69 @@ def main(state_str: str, old_precinct_loc: str, vtd_loc = None, output_loc = Non
         assert abs(old_precincts[election_cols].sum() - vtds[election_cols].sum()).sum() < 1, f"{state_str}"
 
     if not output_loc:
-        vtds.to_file(f"products/{state_str.upper()}_vtd20.shp")
+        vtds.to_file(f"products/{state_str.upper()}_vtd20.shp", engine=IO_ENGINE)
     else:
-        if driver:
-            vtds.to_file(output_loc, driver=driver)
+        if output_loc.endswith(".parquet"):
+            vtds.to_parquet(output_loc)
+        elif driver:
+            vtds.to_file(output_loc, driver=driver, engine=IO_ENGINE)
         else:
-            vtds.to_file(output_loc)
+            vtds.to_file(output_loc, engine=IO_ENGINE)
 
     if export_blocks:
-        blocks.to_file(f"products/{state_str.upper()}_block20.shp")
+        if blocks is None:
+            blocks = load_or_cache(blocks_loc, crs)
+        else:
+            # Every county's prorated votes, summed (this used to be just the last county's, with NaN elsewhere)
+            blocks[election_cols] = block_votes
+        blocks.to_file(f"products/{state_str.upper()}_block20.shp", engine=IO_ENGINE)
 
-def transfer_votes(source: gpd.GeoDataFrame, target: gpd.GeoDataFrame, units: gpd.GeoDataFrame, columns: List[str], epsilon_range = (7, 10), scaling = "VAP20", verbose = False):
-    assignment = maup.assign(units, source)
+def load_or_cache(path: str, crs: str):
+    """
+    Reads a layer reprojected to crs, caching the reprojected layer as GeoParquet next to it.
+    """
+    cache_path = f"{os.path.splitext(path)[0]}.{crs.replace(':', '')}.parquet"
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        return gpd.read_parquet(cache_path)
 
-    closest_weights_vtd_diff = len(target)
-    start, stop = epsilon_range
-    for epsilon_magnitude in range(start, stop+1):
-        epsilon = pow(10, -1 * epsilon_magnitude)
+    layer = gpd.read_file(path, engine=IO_ENGINE)
+    # geopandas already sends every vertex through PROJ in one batched call; in place just skips copying the frame
+    layer.to_crs(crs, inplace=True)
+    try:
+        layer.to_parquet(cache_path)
+    except OSError as e: # e.g. a read-only data directory; the cache is only a shortcut, so carry on without it
+        warnings.warn(f"Could not cache {path} at {cache_path}: {e}")
+        if os.path.exists(cache_path):
+            os.remove(cache_path) # don't leave a partial cache behind for the next run
+    return layer
 
-        units_adjusted = units[scaling].replace(0, epsilon)
+def transfer_votes(source: gpd.GeoDataFrame, target: gpd.GeoDataFrame, units: gpd.GeoDataFrame, columns: List[str], epsilon_range = (7, 10), scaling = "VAP20", verbose = False, assignment_to_target = None):
+    assignment = assign_units(units, source)
+    # Factorize once into source positions; the epsilon search and every column's prorate reuse these codes
+    codes = source.index.get_indexer(assignment) # unassigned units get -1
 
-        if verbose:
-            print("Sums diff:", units_adjusted.sum() - units_adjusted.sum(), "with epsilon:", epsilon)
+    start, stop = epsilon_range
+    epsilons = np.power(10.0, -np.arange(start, stop+1))
+    weights, weights_vtd_diffs = epsilon_weights(units[scaling].to_numpy(dtype=float), codes, len(source), len(target), epsilons)
 
-        attempted_weights = units_adjusted / assignment.map(units_adjusted.groupby(assignment).sum())
-        weights_vtd_diff = attempted_weights.sum() - len(target)
-        if weights_vtd_diff <= closest_weights_vtd_diff:
-            weights = attempted_weights
+    if verbose:
+        for epsilon, weights_vtd_diff in zip(epsilons, weights_vtd_diffs):
+            print("Weights diff:", weights_vtd_diff, "with epsilon:", epsilon)
 
-    units[columns] = maup.prorate(assignment, source[columns], weights)
+    if assignment_to_target is None:
+        assignment_to_target = assign_units(units, target)
+    target_codes = target.index.get_indexer(assignment_to_target)
+    in_target = target_codes >= 0
 
-    assignment_to_target = maup.assign(units, target)
-    target[columns] = units[columns].groupby(assignment_to_target).sum()
+    # Each election column is prorated and aggregated independently, and the
+    # numpy work inside releases the GIL, so spread the columns over threads.
+    # (Unassigned units gather an arbitrary row, but their NaN weight drops it again.)
+    if len(columns): # nothing to prorate (or to stack) without any columns
+        with ThreadPoolExecutor(max_workers=min(len(columns), os.cpu_count() or 1)) as executor:
+            units[columns] = np.column_stack(list(executor.map(
+                lambda column: source[column].to_numpy(dtype=float)[codes] * weights, columns)))
+            target[columns] = np.column_stack(list(executor.map(
+                lambda column: np.bincount(target_codes[in_target], weights=np.nan_to_num(units[column].to_numpy(dtype=float)[in_target]), minlength=len(target)), columns)))
 
     if verbose:
         print("Sum of absolute vote error on blocks", abs(source[columns].sum() - units[columns].sum()).sum())
@@ -148,51 +197,128 @@ def transfer_votes(source: gpd.GeoDataFrame, target: gpd.GeoDataFrame, units: gp
 
     return target
 
+def epsilon_weights(values, codes, n_groups, target_len, epsilons):
+    """
+    Numeric kernel for the epsilon search in transfer_votes. Zero values are bumped to epsilon, each
+    unit is weighted by its share of its group, and the weights for the epsilon whose weight sum lands
+    closest to target_len are returned along with every epsilon's distance. NaN values are treated as 0.
+    """
+    values = np.nan_to_num(values) # a missing value counts as zero rather than poisoning its whole group
+    assigned = codes >= 0
+    zero_mask = values == 0
+
+    # Only the zero-valued units depend on epsilon, so two passes over the units give every epsilon's group sums
+    nonzero_sums = np.bincount(codes[assigned], weights=values[assigned], minlength=n_groups)
+    zero_counts = np.bincount(codes[assigned & zero_mask], minlength=n_groups)
+    group_sums = nonzero_sums + np.outer(epsilons, zero_counts)
+
+    # Each non-empty group's weights add up to group_sum / group_sum (empty groups give 0/0 and drop out)
+    with np.errstate(invalid="ignore"):
+        weights_vtd_diffs = np.abs(np.nansum(group_sums / group_sums, axis=1) - target_len)
+    best = len(epsilons) - 1 - np.argmin(weights_vtd_diffs[::-1]) # ties go to the smaller epsilon
+
+    # Build the winning weights in a single buffer: bump the zeros, then divide in place
+    weights = np.where(zero_mask, epsilons[best], values)
+    np.divide(weights, group_sums[best][codes], out=weights, where=assigned)
+    weights[~assigned] = np.nan
+    return weights, weights_vtd_diffs
+
+def assign_units(units, targets):
+    """
+    Vectorized maup.assign: each unit goes to the target that covers it, or else to the target it overlaps the most.
+    """
+    unit_geoms = units["geometry"].to_numpy()
+    target_geoms = targets["geometry"].to_numpy()
+
+    # Query the big targets against a tree of the small units: each target is prepared once,
+    # rather than testing every small unit against an unprepared target
+    positions = np.full(len(units), -1)
+    target_idx, unit_idx = shapely.STRtree(unit_geoms).query(target_geoms, predicate="covers")
+    positions[unit_idx] = target_idx
+    positions[np.bincount(unit_idx, minlength=len(units)) > 1] = -1 # covered twice, so let area decide
+
+    uncovered = np.nonzero(positions == -1)[0]
+    if len(uncovered):
+        target_idx, unit_idx = shapely.STRtree(unit_geoms[uncovered]).query(target_geoms, predicate="intersects")
+        areas = shapely.area(shapely.intersection(unit_geoms[uncovered[unit_idx]], target_geoms[target_idx]))
+        # Sort by unit, then largest area, then target order, so the first hit for each unit is the one maup picks
+        order = np.lexsort((target_idx, -areas, unit_idx))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = unit_idx[order][1:] != unit_idx[order][:-1]
+        best = order[first]
+        best = best[areas[best] > 0]
+        positions[uncovered[unit_idx[best]]] = target_idx[best]
+
+    assignment = pd.Series(targets.index.to_numpy()[positions], index=units.index)
+    if (positions == -1).any():
+        return assignment.astype(object).where(positions >= 0)
+    return assignment
+
 def close_matches(source, target, threshold = 0.9, reverse = False, ignore_top_issues = False):
     """
     Finds close matches in the source and target geometries (assumes that the threshold is > .5).
     """
-    mapping = {}
-    assignment = maup.assign(source, target)
+    assignment = assign_units(source, target).dropna()
     target_union = target.unary_union.buffer(0)
-    for count, source_geom in source["geometry"].items():
-        try:
-            target_geom = target["geometry"][assignment[count]]
-        except KeyError:
-            continue
-
-        filtered_source = source_geom.intersection(target_union).buffer(0)
-        target_geom = target_geom.buffer(0)
-        try:
-            if (source_geom.intersection(target_geom).area / filtered_source.union(target_geom).area) >= threshold:
-            # if (source_geom.intersection(target_geom).area / min(source_geom.area, target_geom.area)) >= threshold:
-                if reverse:
-                    mapping[assignment[count]] = count
-                else:
-                    mapping[count] = assignment[count]
-        except shapely.errors.TopologicalError as e:
-            print("Topological error", e)
-            if not ignore_top_issues:
-                raise
-
-    return pd.Series(mapping)
+
+    target_positions = target.index.get_indexer(assignment)
+
+    source_geoms = source["geometry"].loc[assignment.index].to_numpy()
+    target_geoms = shapely.buffer(target["geometry"].to_numpy()[target_positions], 0)
+
+    # The bounding box overlap caps the intersection and the target caps the union,
+    # so only pairs that clear the threshold on that bound need exact intersections.
+    target_areas = shapely.area(target_geoms)
+    ratios = np.zeros(len(assignment))
+    candidates = np.nonzero(bbox_overlap_areas(source_geoms, target_geoms) >= threshold * target_areas)[0]
+    filtered_sources = shapely.buffer(shapely.intersection(source_geoms[candidates], target_union), 0)
+
+    try:
+        ratios[candidates] = overlap_ratios(source_geoms[candidates], target_geoms[candidates], filtered_sources, target_areas[candidates])
+    except (shapely.errors.TopologicalError, shapely.errors.GEOSException):
+        # A single bad pair fails the whole batch, so fall back to checking pair by pair
+        for count, filtered_source in zip(candidates, filtered_sources):
+            try:
+                ratios[count] = overlap_ratios(source_geoms[count], target_geoms[count], filtered_source, target_areas[count])
+            except (shapely.errors.TopologicalError, shapely.errors.GEOSException) as e:
+                print("Topological error", e)
+                if not ignore_top_issues:
+                    raise
+
+    # Build the result from typed label arrays; maup hands back object dtype whenever anything was unassigned
+    keep = ratios >= threshold
+    source_labels = assignment.index.to_numpy()[keep]
+    target_labels = target.index.to_numpy()[target_positions[keep]]
+    if reverse:
+        return pd.Series(source_labels, index=target_labels, copy=False)
+    return pd.Series(target_labels, index=source_labels, copy=False)
+
+def overlap_ratios(source_geoms, target_geoms, filtered_sources, target_areas):
+    """
+    Vectorized ratio of the intersection of each source/target pair to their union.
+    """
+    # Each target lies inside the target union, so the filtered source meets it exactly where the
+    # source does, and the union's area follows from inclusion-exclusion without building it.
+    intersection_areas = shapely.area(shapely.intersection(source_geoms, target_geoms))
+    return intersection_areas / (shapely.area(filtered_sources) + target_areas - intersection_areas)
+
+def bbox_overlap_areas(source_geoms, target_geoms):
+    """
+    Vectorized area of the overlap between the bounding boxes of each source/target pair.
+    """
+    source_bounds = shapely.bounds(source_geoms)
+    target_bounds = shapely.bounds(target_geoms)
+    widths = np.minimum(source_bounds[:, 2], target_bounds[:, 2]) - np.maximum(source_bounds[:, 0], target_bounds[:, 0])
+    heights = np.minimum(source_bounds[:, 3], target_bounds[:, 3]) - np.maximum(source_bounds[:, 1], target_bounds[:, 1])
+    return np.maximum(widths, 0) * np.maximum(heights, 0)
 
 def autodetect_election_cols(columns, include_cvap = False):
     """
     Attempt to autodetect election cols from a given list
     """
-    partial_cols = ["SEN", "PRES", "GOV", "TRE", "AG", "LTGOV", "AUD", "USH", "SOS", "CAF", "SSEN", "STH", "TOTVOTE", "RGOV", "DGOV", "DPRES", "RPRES", "DSC", "RSC", "EL", "G16", "G17", "G18", "G20", "COMP", "ATG", "SH", "SP_SEN", "USS", "SOC", "BOSMAY", "SS08P", "SS13P", "LTG", "LG"]
     if include_cvap:
-        election_cols = [x for x in columns if any([x.startswith(y) or "CVAP" in x for y in partial_cols])]
-    else:
-        election_cols = [x for x in columns if any([x.startswith(y) for y in partial_cols])]
-
-    if "SEND" in election_cols:
-        del election_cols[election_cols.index("SEND")]
-    if "SENDIST" in election_cols:
-        del election_cols[election_cols.index("SENDIST")]
-
-    return election_cols
+        return [x for x in columns if ELECTION_COL_PATTERN.match(x) or "CVAP" in x]
+    return [x for x in columns if ELECTION_COL_PATTERN.match(x)]
 
 if __name__ == "__main__":
     typer.run(main)
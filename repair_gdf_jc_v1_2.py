@@ -9,6 +9,11 @@
 #     min_rook_length = None; this step will be skipped unless a
 #     length threshold is provided.
 
+# Optionally, a grid_size can be given to snap-round all the boundary 
+# coordinates to a fixed precision grid while they are being noded.  This gets
+# rid of near-coincident vertices up front and makes the noding step faster on
+# big, noisy shapefiles.  Default is grid_size = None (full precision).
+
 # Note that (2) and (3) are optional but (1) is not!  The procedure for (1)
 # produces a clean tiling of the region that is necessary for the procedures
 # in (2) and (3) to work properly.  (If the region is already free of overlaps,
@@ -122,8 +127,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 import shapely as shp
-from shapely.ops import unary_union, split, polygonize, linemerge
-from shapely.geometry import Polygon, MultiPolygon, Point, MultiPoint, LineString, MultiLineString
+from shapely.ops import unary_union, split, polygonize
+from shapely.geometry import Polygon, MultiPolygon, LineString, MultiLineString
 from shapely.strtree import STRtree
 
 import maup
@@ -132,8 +137,13 @@ from maup.indexed_geometries import get_geometries
 from maup.crs import require_same_crs
 from maup.progress_bar import progress
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from itertools import combinations
 from math import sqrt
+from operator import itemgetter
+import heapq
+import os
 
 import warnings; warnings.filterwarnings('ignore', 'GeoSeries.isna', UserWarning)
 
@@ -143,14 +153,29 @@ pd.options.mode.chained_assignment = None
 
 # Some useful short functions:
 
-# Count the number of connected components of a shapely object:
+# Count the number of connected components of a shapely object (or of each object
+# in an array of them):
 def num_components_jc(geom):  
-    if geom.is_empty:
-        return 0
-    elif (geom.geom_type == "Polygon") or (geom.geom_type == "Point") or (geom.geom_type == "LineString"):
-        return 1
-    elif (geom.geom_type == "MultiPolygon") or (geom.geom_type == "MultiLineString") or (geom.geom_type == "GeometryCollection"):
-        return len(geom)
+    return np.where(shp.is_empty(geom), 0, shp.get_num_geometries(geom))[()]
+
+
+
+# Noded linework for polygon boundaries that already form a valid coverage.  Shared
+# edges match vertex for vertex, so all that's needed is to break the rings into 
+# segments and keep one copy of each:
+def coverage_edges_jc(boundaries):
+    coords, ring_inds = shp.get_coordinates(boundaries, return_index=True)
+    same_ring = ring_inds[:-1] == ring_inds[1:]
+    segments = np.stack([coords[:-1], coords[1:]], axis=1)[same_ring]
+    
+    # Orient every segment the same way so both copies of a shared edge agree:
+    flip = (segments[:, 0, 0] > segments[:, 1, 0]) | (
+        (segments[:, 0, 0] == segments[:, 1, 0]) & (segments[:, 0, 1] > segments[:, 1, 1]))
+    segments[flip] = segments[flip, ::-1]
+    segments = segments[(segments[:, 0] != segments[:, 1]).any(axis=1)]
+    segments = np.unique(segments.reshape(-1, 4), axis=0).reshape(-1, 2, 2)
+    
+    return shp.multilinestrings(shp.linestrings(segments))
 
 
 
@@ -165,21 +190,25 @@ def adjacencies_jc(geometries_df, adjacency_type="rook"):
         raise ValueError('adjacency_type must be "rook" or "queen"')
 
     geometries = get_geometries(geometries_df)
+    geoms = geometries.values
+    
+    spatial_index = STRtree(geoms)
     
-    spatial_index = STRtree(geometries)
-    index_by_id = dict((id(geom), i) for i, geom in geometries.items()) 
+    # All intersecting pairs in one query, each pair kept once.  The pairs come out 
+    # grouped by geometry and in tree order within each group, like the old loop, and
+    # that order matters to small_rook_to_queen_jc, so don't sort them!
+    left, right = spatial_index.query(geoms, predicate="intersects")
+    labels = geometries.index.values
+    keep = labels[right] > labels[left]
+    left, right = left[keep], right[keep]
     
-    adj_indices = []
-    adj_geoms = []
+    inters = shp.intersection(geoms[right], geoms[left])
+    keep = ~shp.is_empty(inters)
+    if adjacency_type == "rook":
+        keep &= shp.length(inters) > 0
     
-    for i in progress(geometries.index, len(geometries.index)):
-        possible_intersect_indices_0 = [(index_by_id[id(geom2)]) for geom2 in spatial_index.query(geometries[i])]
-        possible_intersect_indices = [j for j in possible_intersect_indices_0 if j > i]
-        for j in possible_intersect_indices:
-            inter = geometries[j].intersection(geometries[i])
-            if (not inter.is_empty) and (adjacency_type == "queen" or inter.length > 0):
-                adj_indices.append({i,j})
-                adj_geoms.append(inter)
+    adj_indices = [{i, j} for i, j in zip(labels[left[keep]], labels[right[keep]])]
+    adj_geoms = inters[keep]
 
     adjacencies_df = gpd.GeoDataFrame({"parent indices" : adj_indices, "geometry" : adj_geoms}, crs = geometries_df.crs)
         
@@ -194,21 +223,18 @@ def intersections_jc(sources, targets):
     source_geoms = get_geometries(sources)
     target_geoms = get_geometries(targets)
     
-    spatial_index = STRtree(target_geoms)
-    index_by_id = dict((id(geom), i) for i, geom in target_geoms.items()) 
-    
-    int_source_indices = []
-    int_target_indices = []
-    int_geoms = []
-
-    for i in progress(source_geoms.index, len(source_geoms.index)):
-        possible_target_intersect_indices = sorted([(index_by_id[id(geom2)]) for geom2 in spatial_index.query(source_geoms[i])])
-        for j in possible_target_intersect_indices:
-            inter = source_geoms[i].intersection(target_geoms[j])
-            if (not inter.is_empty):
-                int_source_indices.append(i)
-                int_target_indices.append(j)
-                int_geoms.append(inter)
+    spatial_index = STRtree(target_geoms.values)
+    
+    source_pos, target_pos = spatial_index.query(source_geoms.values, predicate="intersects")
+    order = np.lexsort((target_pos, source_pos))
+    source_pos, target_pos = source_pos[order], target_pos[order]
+    
+    inters = shp.intersection(source_geoms.values[source_pos], target_geoms.values[target_pos])
+    keep = ~shp.is_empty(inters)
+    
+    int_source_indices = source_geoms.index.values[source_pos[keep]]
+    int_target_indices = target_geoms.index.values[target_pos[keep]]
+    int_geoms = inters[keep]
                                    
     intersections_df = gpd.GeoDataFrame({"source" : int_source_indices, "target" : int_target_indices, "geometry" : int_geoms}, crs = sources.crs)
 
@@ -216,7 +242,7 @@ def intersections_jc(sources, targets):
 
 
 # MAIN FUNCTION:
-def repair_gdf_jc(geometries0_df, close_gaps = True, min_rook_length = None):
+def repair_gdf_jc(geometries0_df, close_gaps = True, min_rook_length = None, grid_size = None):
     
     if isinstance(geometries0_df, gpd.GeoDataFrame) == False:
         raise TypeError(f"Input must be a GeoDataFrame!")
@@ -224,9 +250,8 @@ def repair_gdf_jc(geometries0_df, close_gaps = True, min_rook_length = None):
     geometries_df = geometries0_df.copy()
     
     # Ensure that geometries are 2-D and not 3-D!
-    for i in geometries_df.index:
-        geometries_df["geometry"][i] = shp.wkb.loads(
-            shp.wkb.dumps(geometries_df["geometry"][i], output_dimension=2))
+    geometries_df["geometry"] = gpd.GeoSeries(
+        shp.force_2d(geometries_df["geometry"].values), index = geometries_df.index, crs = geometries_df.crs)
             
     # Warn if crs is geographic:
     if geometries_df.crs is not None:
@@ -234,7 +259,7 @@ def repair_gdf_jc(geometries0_df, close_gaps = True, min_rook_length = None):
             warnings.warn("Geometry is in a geographic CRS. Results from 'length' are likely incorrect. Use 'GeoSeries.to_crs()' to re-project geometries to a projected CRS before this operation.")
     
     # Construct data about overlaps of all orders, plus holes.
-    overlap_tower, holes_df = building_blocks_jc(geometries_df)
+    overlap_tower, holes_df = building_blocks_jc(geometries_df, grid_size = grid_size)
 
     # Use data from the overlap tower to rebuild precincts with no overlaps.
     print("Resolving overlaps...")
@@ -252,67 +277,62 @@ def repair_gdf_jc(geometries0_df, close_gaps = True, min_rook_length = None):
     # If the area is not negligible, leave it alone and report it so that a human
     # can decide what to do about it!
     
-    disconnected_df = reconstructed_df[reconstructed_df["geometry"].apply(lambda x: x.type != "Polygon")]
+    not_polygon = shp.get_type_id(reconstructed_df["geometry"].values) != 3
     # This will include precincts that were disconnected in the original; need to 
     # filter by whether they got worse.
     
-    if len(disconnected_df) > 0:
-        disconnected_poly_indices = []
-        for ind in disconnected_df.index:
-            if num_components_jc(reconstructed_df["geometry"][ind]) > num_components_jc(geometries0_df["geometry"][ind]):
-                disconnected_poly_indices.append(ind)
+    if not_polygon.any():
+        got_worse = num_components_jc(reconstructed_df["geometry"].values) > num_components_jc(geometries0_df["geometry"].values)
+        disconnected_poly_indices = reconstructed_df.index[not_polygon & got_worse].tolist()
                 
         if len(disconnected_poly_indices) > 0: # These are the ones (if any) that got worse.
             geometries = get_geometries(reconstructed_df)
-            spatial_index = STRtree(geometries)
-            index_by_id = dict((id(geom), i) for i, geom in geometries.items()) 
+            spatial_index = STRtree(geometries.values)
             
             for g_ind in disconnected_poly_indices:
                 excess = num_components_jc(reconstructed_df["geometry"][g_ind]) - num_components_jc(geometries0_df["geometry"][g_ind])
                 
-                component_num_list = [x for x in range(len(reconstructed_df["geometry"][g_ind]))]
-                component_areas = []                                                                                    
-                
-                for c_ind in range(len(reconstructed_df["geometry"][g_ind])):
-                    component_areas.append((c_ind, reconstructed_df["geometry"][g_ind][c_ind].area))
+                components = shp.get_parts(reconstructed_df["geometry"][g_ind])
+                component_num_list = [x for x in range(len(components))]
+                component_areas = list(enumerate(shp.area(components)))
                 
-                component_areas_sorted = sorted(component_areas, key=lambda tup: tup[1])
+                component_areas_sorted = heapq.nsmallest(excess, component_areas, key=itemgetter(1))
                 
                 big_area = max([reconstructed_df["geometry"][g_ind].area, geometries0_df["geometry"][g_ind].area])
                 
                 for i in range(excess): # Check that the ith smallest component has small enough area and
                     c_ind = component_areas_sorted[i][0]
-                    this_fragment = reconstructed_df["geometry"][g_ind][c_ind]
+                    this_fragment = components[c_ind]
                     if component_areas_sorted[i][1] < 0.0001*big_area:  # Less than 0.01%
                         component_num_list.remove(c_ind) # Tells us to take out this component later
-                        possible_intersect_indices = [(index_by_id[id(geom)]) for geom in spatial_index.query(this_fragment)]
+                        possible_intersect_indices = geometries.index.values[spatial_index.query(this_fragment, predicate="intersects")]
+                        possible_intersect_indices = possible_intersect_indices[possible_intersect_indices != g_ind]
                         
-                        shared_perimeters = []
-                        for g_ind2 in possible_intersect_indices:
-                            if g_ind2 != g_ind and not (this_fragment.boundary).intersection(reconstructed_df["geometry"][g_ind2].boundary).is_empty:
-                                shared_perimeters.append((g_ind2, (this_fragment.boundary).intersection(reconstructed_df["geometry"][g_ind2].boundary).length))
+                        shared_boundaries = shp.intersection(this_fragment.boundary, 
+                            shp.boundary(reconstructed_df["geometry"][possible_intersect_indices].values))
+                        touching = ~shp.is_empty(shared_boundaries)
+                        shared_perimeters = shp.length(shared_boundaries[touching])
 
-                        max_shared_perim = sorted(shared_perimeters, key=lambda tup: tup[1])[-1]
-                        poly_to_add_to = max_shared_perim[0]
+                        # Last of any ties, as the old sorted(...)[-1] picked:
+                        poly_to_add_to = possible_intersect_indices[touching][len(shared_perimeters) - 1 - np.argmax(shared_perimeters[::-1])]
                         reconstructed_df["geometry"][poly_to_add_to] = unary_union(
                             [reconstructed_df["geometry"][poly_to_add_to], this_fragment])
                         
                 if len(component_num_list) == 1:
-                    reconstructed_df["geometry"][g_ind] = reconstructed_df["geometry"][g_ind][component_num_list[0]]
+                    reconstructed_df["geometry"][g_ind] = components[component_num_list[0]]
                 elif len(component_num_list) > 1:
                     reconstructed_df["geometry"][g_ind] = MultiPolygon(
-                        [reconstructed_df["geometry"][g_ind][c_ind] for c_ind in component_num_list])
+                        [components[c_ind] for c_ind in component_num_list])
                 else:
                     print("WARNING: A component of the geometry at index ", g_ind, " was badly disconnected and redistributed to other polygons!")
                 
     # We SHOULD be back to the correct number of components everywhere, but check again just to make sure!                
 
-    disconnected_df_2 = reconstructed_df[reconstructed_df["geometry"].apply(lambda x: x.type != "Polygon")]
+    not_polygon = shp.get_type_id(reconstructed_df["geometry"].values) != 3
+    got_worse = num_components_jc(reconstructed_df["geometry"].values) > num_components_jc(geometries0_df["geometry"].values)
     
-    if len(disconnected_df_2) > 0:
-        for ind in disconnected_df_2.index:
-            if num_components_jc(reconstructed_df["geometry"][ind]) > num_components_jc(geometries0_df["geometry"][ind]):
-                print("WARNING: A component of the geometry at index ", ind, " may have been disconnected!")
+    for ind in reconstructed_df.index[not_polygon & got_worse]:
+        print("WARNING: A component of the geometry at index ", ind, " may have been disconnected!")
 
     if min_rook_length is not None:
         # Find all inter-polygon boundaries shorter than min_rook_length and replace them
@@ -330,7 +350,7 @@ def repair_gdf_jc(geometries0_df, close_gaps = True, min_rook_length = None):
 # partition according to which polygons in the original intersected to create it,
 # and organize this data according to order of the overlaps.  (Order zero = hole)
 
-def building_blocks_jc(geometries0_df):
+def building_blocks_jc(geometries0_df, grid_size = None):
     if isinstance(geometries0_df, gpd.GeoDataFrame) == False:
         raise TypeError(f"Input must be a GeoDataFrame!")
 
@@ -339,12 +359,21 @@ def building_blocks_jc(geometries0_df):
     # Make a list of all the boundaries of all the polygons. 
     # This won't work properly with multi-polygons, so explode first:
     
-    boundaries = []
-    geometries_exploded_df = geometries_df.explode().reset_index(drop=True)
-    for i in geometries_exploded_df.index:
-        boundaries.append(LineString(list(geometries_exploded_df["geometry"][i].exterior.coords)))
+    geometries_exploded_df = geometries_df.explode(index_parts=False).reset_index(drop=True)
+    boundaries = shp.get_exterior_ring(geometries_exploded_df["geometry"].values)
     
-    boundaries_union = unary_union(boundaries)
+    # Snap-rounding to a grid needs GEOS >= 3.9; without it, node at full precision.
+    if grid_size is not None and shp.geos_version < (3, 9, 0):
+        warnings.warn("grid_size requires GEOS >= 3.9; noding boundaries at full precision instead.")
+        grid_size = None
+    
+    # If the polygons already form a valid coverage there's nothing to node; just
+    # drop the duplicate copies of shared edges.  (Needs GEOS >= 3.12.)
+    if (grid_size is None and shp.geos_version >= (3, 12, 0) and hasattr(shp, "coverage_is_valid")
+            and shp.coverage_is_valid(geometries_exploded_df["geometry"].values)):
+        boundaries_union = coverage_edges_jc(boundaries)
+    else:
+        boundaries_union = shp.union_all(boundaries, grid_size = grid_size)
     
     # Create geodataframe with all the pieces created by overlaps of all orders, 
     # together with a set for each piece consisting of the polygons that created the overlap.
@@ -353,21 +382,15 @@ def building_blocks_jc(geometries0_df):
                                 geometry = gpd.GeoSeries([geom for geom in polygonize(boundaries_union)]),
                                 crs = geometries_df.crs)
 
-    for i in pieces_df.index:
-        pieces_df["polygon indices"][i] = set()
-        
-        
-    g_spatial_index = STRtree(geometries_df["geometry"]) # Build STRtree for the main geometries
-    g_index_by_id = dict((id(geom), i) for i, geom in geometries_df["geometry"].items())  # Build indexing dictionary
+    g_spatial_index = STRtree(geometries_df["geometry"].values, node_capacity=16) # Build STRtree for the main geometries
 
+    # A piece lies in every polygon that contains its representative point; find
+    # all (piece, polygon) pairs in one query and collect them into sets.
     print("Identifying overlaps...")
-    for i in progress(pieces_df.index, len(pieces_df.index)): 
-        possible_geom_indices = [
-            (g_index_by_id[id(geom)]) for geom in g_spatial_index.query(pieces_df["geometry"][i])
-            ]            
-        for j in possible_geom_indices:
-            if pieces_df["geometry"][i].representative_point().distance(geometries_df["geometry"][j]) == 0:
-                pieces_df["polygon indices"][i] = pieces_df["polygon indices"][i].union({j})
+    rep_points = shp.point_on_surface(pieces_df["geometry"].values)
+    piece_pos, geom_pos = g_spatial_index.query(rep_points, predicate="intersects")
+    polygon_indices = pd.Series(geometries_df.index.values[geom_pos]).groupby(piece_pos).agg(set)
+    pieces_df["polygon indices"] = [polygon_indices.get(i, set()) for i in range(len(pieces_df))]
 
     
     
@@ -410,7 +433,10 @@ def reconstruct_from_overlap_tower_jc(geometries0_df, overlap_tower0):
     geometries_df = geometries0_df.copy()
     overlap_tower = [df.copy() for df in overlap_tower0]
     
-    geometries_df["geometry"] = Polygon()
+    # The geometries get rebuilt piece by piece, so keep them in a plain dict keyed
+    # by index while working and write the whole column back once at the end.
+    new_geoms = dict.fromkeys(geometries_df.index, Polygon())
+    new_boundaries = {}  # Boundaries of new_geoms, dropped whenever a geometry changes
     #geometries_df["geometry_new"] = Polygon()
     #geometries_df = geometries_df.set_geometry("geometry_new")
     #del geometries_df["geometry"]
@@ -420,21 +446,18 @@ def reconstruct_from_overlap_tower_jc(geometries0_df, overlap_tower0):
 
     # Start by assigning all order-1 pieces to the polygon they came from:
     
-    for ind in overlap_tower[0].index:
-        this_poly_ind = list(overlap_tower[0]["polygon indices"][ind])[0]
-        this_piece = overlap_tower[0]["geometry"][ind]
-        geometries_df["geometry"][this_poly_ind] = unary_union([geometries_df["geometry"][this_poly_ind], this_piece])
+    order_1_pieces = defaultdict(list)
+    for poly_inds, this_piece in zip(overlap_tower[0]["polygon indices"], overlap_tower[0]["geometry"]):
+        order_1_pieces[list(poly_inds)[0]].append(this_piece)
+    for this_poly_ind, these_pieces in order_1_pieces.items():
+        new_geoms[this_poly_ind] = unary_union(these_pieces)
 
     # IMPORTANT: We need to know which geometries were disconnected by removing  
     # overlaps! Add columns for numbers of components in the original and refined 
     # geometries to each dataframe for future use.
 
-    geometries_df["num components orig"] = 0
-    geometries_df["num components refined"] = 0
-        
-    for ind in geometries_df.index:
-        geometries_df["num components orig"][ind] = num_components_jc(geometries0_df["geometry"][ind])
-        geometries_df["num components refined"][ind] = num_components_jc(geometries_df["geometry"][ind])
+    geometries_df["num components orig"] = num_components_jc(geometries0_df["geometry"].values)
+    geometries_df["num components refined"] = num_components_jc(np.array(list(new_geoms.values()), dtype=object))
 
     # Now, start with the order-2 and gradually add overlaps at higher order until done.
     
@@ -446,21 +469,18 @@ def reconstruct_from_overlap_tower_jc(geometries0_df, overlap_tower0):
     # can disconnect two polygons, and only one of them gets to grab it back.
     # This will be addressed at the end, within the main function.)
 
-    geometries_disconnected_df = geometries_df[geometries_df["num components refined"] > geometries_df["num components orig"]]
+    disconnected_indices = geometries_df.index[geometries_df["num components refined"] > geometries_df["num components orig"]].tolist()
 
     for i in range(1, max_overlap_level):
         overlaps_df = overlap_tower[i]  
         overlaps_df_unused_indices = overlaps_df.index.tolist() 
             # Need to make sure each overlap only gets used once!
         
-        o_spatial_index = STRtree(overlaps_df["geometry"]) # Build STRtree for the overlaps
-        o_index_by_id = dict((id(geom), i) for i, geom in overlaps_df["geometry"].items())  # Build indexing dictionary
+        o_spatial_index = STRtree(overlaps_df["geometry"].values, node_capacity=16) # Build STRtree for the overlaps
         
-        for g_ind in geometries_disconnected_df.index:
-            possible_overlap_indices_0 = [
-                (o_index_by_id[id(geom)]) for geom in o_spatial_index.query(geometries_disconnected_df["geometry"][g_ind])
-            ]
-            possible_overlap_indices = list(set(possible_overlap_indices_0) & set(overlaps_df_unused_indices))
+        for g_ind in list(disconnected_indices):
+            possible_overlap_indices_0 = overlaps_df.index.values[o_spatial_index.query(new_geoms[g_ind], predicate="intersects")]
+            possible_overlap_indices = sorted(set(possible_overlap_indices_0) & set(overlaps_df_unused_indices))
 
             
             geom_finished = False  # Only keep adding things until it gets connected again
@@ -469,53 +489,73 @@ def reconstruct_from_overlap_tower_jc(geometries0_df, overlap_tower0):
                 # If the corresponding overlap intersects this geometry (and was 
                 # contained in it originally!), grab it.
                 
-                if (geom_finished == False) and (g_ind in list(overlaps_df["polygon indices"][o_ind])) and (not geometries_disconnected_df["geometry"][g_ind].intersection(overlaps_df["geometry"][o_ind]).is_empty):
+                if (geom_finished == False) and (g_ind in overlaps_df["polygon indices"][o_ind]):
                     
-                    if (geometries_disconnected_df["geometry"][g_ind].intersection(overlaps_df["geometry"][o_ind])).length > 0:
-                        geometries_disconnected_df["geometry"][g_ind] = unary_union([
-                            geometries_disconnected_df["geometry"][g_ind], overlaps_df["geometry"][o_ind]
+                    if shp.length(shp.intersection(new_geoms[g_ind], overlaps_df["geometry"][o_ind])) > 0:
+                        new_geoms[g_ind] = unary_union([
+                            new_geoms[g_ind], overlaps_df["geometry"][o_ind]
                         ])
+                        new_boundaries.pop(g_ind, None)
                         overlaps_df_unused_indices.remove(o_ind)
-                        if num_components_jc(geometries_disconnected_df["geometry"][g_ind]) == geometries_df["num components orig"][g_ind]:
+                        if num_components_jc(new_geoms[g_ind]) == geometries_df["num components orig"][g_ind]:
                              geom_finished = True
-        
-            geometries_df["geometry"][g_ind] = geometries_disconnected_df["geometry"][g_ind]
                 
             if geom_finished == True:
-                geometries_disconnected_df = geometries_disconnected_df.drop(g_ind)
+                disconnected_indices.remove(g_ind)
         
             # Okay, that's all we can do for the disconnected geometries at this level.
             # Go on to filling in the rest of the overlaps by greatest perimeter.
 
 
-        g_spatial_index = STRtree(geometries_df["geometry"]) # Build STRtree for the main geometries
-        g_index_by_id = dict((id(geom), i) for i, geom in geometries_df["geometry"].items()) # Build indexing dictionary
-
+        # Each remaining overlap can only go to one of the polygons it came from, so
+        # pair every overlap with its parents and measure all the shared perimeters
+        # in one go.
         print("Assigning order", i+1, "pieces...")
-        for o_ind in progress(overlaps_df_unused_indices, len(overlaps_df_unused_indices)):
-            this_overlap = overlaps_df["geometry"][o_ind]
-            
-            shared_perimeters = []
-            
-            possible_geom_indices = [
-                (g_index_by_id[id(geom)]) for geom in g_spatial_index.query(overlaps_df["geometry"][o_ind])
-            ]
-
-            
-            for g_ind in possible_geom_indices:
-                if (g_ind in list(overlaps_df["polygon indices"][o_ind])) and not (this_overlap.boundary).intersection(geometries_df["geometry"][g_ind].boundary).is_empty:
-                    shared_perimeters.append((g_ind, (this_overlap.boundary).intersection(geometries_df["geometry"][g_ind].boundary).length))
-
-            # This possibility came up in a previous version, but I hope it will be 
-            # obsolete in this version!       
-            if len(shared_perimeters) > 0:
-                max_shared_perim = sorted(shared_perimeters, key=lambda tup: tup[1])[-1]
-                poly_to_add_to = max_shared_perim[0]
-                geometries_df["geometry"][poly_to_add_to] = unary_union(
-                    [geometries_df["geometry"][poly_to_add_to], this_overlap])
-            else:
-                print("Couldn't find a polygon to glue a component of intersection ", multi_index, " to")
-    
+        parent_pairs = overlaps_df["polygon indices"][overlaps_df_unused_indices].apply(sorted).explode()
+        pair_o_inds = parent_pairs.index.values
+        pair_g_inds = parent_pairs.values
+        
+        # Only the unused overlaps need boundaries, and only parents that changed
+        # since the last level need theirs recomputed.
+        overlap_boundaries = shp.boundary(overlaps_df["geometry"][overlaps_df_unused_indices].values)
+        stale_g_inds = [g_ind for g_ind in set(pair_g_inds) if g_ind not in new_boundaries]
+        new_boundaries.update(zip(stale_g_inds, shp.boundary(np.array([new_geoms[g_ind] for g_ind in stale_g_inds], dtype=object))))
+        
+        pair_o_pos = pd.Index(overlaps_df_unused_indices).get_indexer(pair_o_inds)
+        pair_g_boundaries = np.array([new_boundaries[g_ind] for g_ind in pair_g_inds], dtype=object)
+        
+        # The pairs are independent and the shapely ufuncs release the GIL, so split 
+        # the intersections across threads in contiguous chunks.
+        n_chunks = max(1, min(os.cpu_count() or 1, len(pair_o_pos) // 256))
+        with ThreadPoolExecutor(max_workers=n_chunks) as executor:
+            shared_boundaries = np.concatenate(list(executor.map(
+                lambda chunk: shp.intersection(overlap_boundaries[pair_o_pos[chunk]], pair_g_boundaries[chunk]),
+                np.array_split(np.arange(len(pair_o_pos)), n_chunks))))
+        shared_lengths = shp.length(shared_boundaries)
+        
+        # Longest shared perimeter per overlap: sort the touching pairs by overlap and
+        # then by decreasing length (last of any ties first, as the old sorted(...)[-1] 
+        # picked), and keep the first pair for each overlap.
+        touching = np.flatnonzero(~shp.is_empty(shared_boundaries))
+        touching = touching[np.lexsort((-touching, -shared_lengths[touching], pair_o_pos[touching]))]
+        best = touching[np.r_[True, pair_o_pos[touching][1:] != pair_o_pos[touching][:-1]]] if len(touching) > 0 else touching
+        
+        # Union everything a polygon picked up at this level in one go, rather than
+        # re-noding the growing polygon once per overlap.
+        pieces_to_add = defaultdict(list)
+        for o_ind, poly_to_add_to in zip(pair_o_inds[best], pair_g_inds[best]):
+            pieces_to_add[poly_to_add_to].append(overlaps_df["geometry"][o_ind])
+        for poly_to_add_to, these_pieces in pieces_to_add.items():
+            new_geoms[poly_to_add_to] = unary_union([new_geoms[poly_to_add_to]] + these_pieces)
+            new_boundaries.pop(poly_to_add_to, None)
+
+        # This possibility came up in a previous version, but I hope it will be 
+        # obsolete in this version!       
+        for o_ind in set(overlaps_df_unused_indices) - set(pair_o_inds[best]):
+            print("Couldn't find a polygon to glue a component of intersection ", o_ind, " to")
+    
+    geometries_df["geometry"] = gpd.GeoSeries(
+        [new_geoms[ind] for ind in geometries_df.index], index = geometries_df.index, crs = geometries_df.crs)
 
     reconstructed_df = geometries_df.copy()   
     
@@ -536,15 +576,19 @@ def close_gaps_jc(geometries0_df, holes0_df):
     
     fill_complete = False
     
+    # Every hole left after a round is a piece of a hole handled in that round, so 
+    # it can only border polygons that bordered the holes handled in that round.
+    # Only those need to be checked against on the next round.
+    nearby_indices = geometries_df.index
+    
     while fill_complete == False:
 
-        hole_boundaries_df = intersections_jc(holes_df, geometries_df) 
+        hole_boundaries_df = intersections_jc(holes_df, geometries_df.loc[nearby_indices]) 
         # Note: all geometries here will (stupidly!) be MultiLineStrings; 
         # convert to LineStrings before exploding.
         
-        for ind in hole_boundaries_df.index:
-            if hole_boundaries_df["geometry"][ind].geom_type == "MultiLineString":
-                hole_boundaries_df["geometry"][ind] = linemerge(hole_boundaries_df["geometry"][ind])
+        multi_lines = hole_boundaries_df["geometry"].geom_type == "MultiLineString"
+        hole_boundaries_df.loc[multi_lines, "geometry"] = shp.line_merge(hole_boundaries_df["geometry"][multi_lines].values)
 
         hole_boundaries_df = hole_boundaries_df.explode().reset_index(drop=True)
         # All geometries here should be LineStrings, or occasionally Points.
@@ -554,21 +598,22 @@ def close_gaps_jc(geometries0_df, holes0_df):
 
         new_holes = []                   # Holes that will be created by partial fills 
                                          # to add before next round
+        boundaries_by_hole = dict(tuple(hole_boundaries_df.groupby("source")))
+        nearby_indices = set()
         for h_ind in progress(holes_df.index, len(holes_df.index)):
              
             this_hole = holes_df["geometry"][h_ind]
-            this_hole_boundaries_df = hole_boundaries_df[hole_boundaries_df["source"] == h_ind]
+            this_hole_boundaries_df = boundaries_by_hole.get(h_ind, hole_boundaries_df.iloc[:0])
+            nearby_indices.update(this_hole_boundaries_df["target"])
             
             if len(set(this_hole_boundaries_df["target"])) <= 3:  # Fill the hole!
                 
-                shared_perimeters = []
-                
-                for b_ind in this_hole_boundaries_df.index:
-                    g_ind = this_hole_boundaries_df["target"][b_ind]
-                    shared_perimeters.append((b_ind, (this_hole.boundary).intersection(geometries_df["geometry"][g_ind].boundary).length))
+                b_targets = this_hole_boundaries_df["target"].values
+                shared_perimeters = shp.length(shp.intersection(
+                    this_hole.boundary, shp.boundary(geometries_df["geometry"][b_targets].values)))
                 
-                max_shared_perim = sorted(shared_perimeters, key=lambda tup: tup[1])[-1]
-                poly_to_add_to = this_hole_boundaries_df["target"][max_shared_perim[0]]
+                # Last of any ties, as the old sorted(...)[-1] picked:
+                poly_to_add_to = b_targets[len(b_targets) - 1 - np.argmax(shared_perimeters[::-1])]
         
                 geometries_df["geometry"][poly_to_add_to] = unary_union(
                     [geometries_df["geometry"][poly_to_add_to], this_hole])
@@ -591,10 +636,12 @@ def close_gaps_jc(geometries0_df, holes0_df):
                 
                     activity_this_round = True
                     
+        nearby_indices = sorted(nearby_indices)
+        
         if activity_this_round == True: # Add any new holes for the next round!
-            for k in range(len(new_holes)):
-                holes_df = holes_df.append({"polygon indices" : {}, "geometry": new_holes[k]}, ignore_index=True)
-                holes_df.reset_index(drop=True)
+            holes_df = pd.concat([holes_df, gpd.GeoDataFrame({"polygon indices" : [set() for hole in new_holes]}, 
+                                                             geometry = new_holes, crs = holes_df.crs)], 
+                                 ignore_index=True)
                 
         else:  # All done!          
             fill_complete = True
@@ -614,30 +661,42 @@ def partial_fill_data_jc(hole0, hole_boundaries_df0):
     # boundary of the hole.
 
     hole = hole0
-    hole_boundaries_df = hole_boundaries_df0.copy()
-    
-    poly_distances = []
-
-    for i in hole_boundaries_df.index:
-        for j in hole_boundaries_df.index:
-            if j > i:
-                this_distance = hole_boundaries_df["geometry"][i].distance(hole_boundaries_df["geometry"][j])
-                if this_distance != 0: #maybe use not is_close?
-                    poly_distances.append((i, j, this_distance))
+    hole_boundary = hole.boundary
+    
+    # The hole and its boundary get tested against candidate lines over and over,
+    # so prepare them once.  (The hole belongs to the caller, so undo that at the end.)
+    hole_was_prepared = shp.is_prepared(hole)
+    shp.prepare(hole)
+    shp.prepare(hole_boundary)
+    hole_boundaries_df = hole_boundaries_df0
+    
+    boundary_geoms = hole_boundaries_df["geometry"].values
+    boundary_lengths = shp.length(boundary_geoms)
+    boundary_targets = hole_boundaries_df["target"].values
+    # The same boundary can come up in several candidate pairs, so get its vertices just once:
+    boundary_coords = [shp.get_coordinates(geom) for geom in boundary_geoms]
+    boundary_end_vertices = [coords[[0, -1]] for coords in boundary_coords]
+    pair_i, pair_j = np.triu_indices(len(boundary_geoms), k=1)
+    pair_distances = shp.distance(boundary_geoms[pair_i], boundary_geoms[pair_j])
+    nonadjacent = pair_distances != 0 #maybe use not is_close?
+    pair_i, pair_j, pair_distances = pair_i[nonadjacent], pair_j[nonadjacent], pair_distances[nonadjacent]
 
                      
     # Choose the shortest-distance non-adjacent pair to connect by gluing a piece 
     # of the hole to one of them.
     
     
-    distance_data_sorted = sorted(poly_distances, key=lambda tup: tup[2])
+    # Keep the pairs in a heap, since usually only the first one or two get used.  The 
+    # pair number breaks ties in the original order.
+    distance_heap = list(zip(pair_distances, range(len(pair_distances)), pair_i, pair_j))
+    heapq.heapify(distance_heap)
     
     poly_pair_found = False
     
-    while poly_pair_found == False and len(distance_data_sorted) > 0:
+    while poly_pair_found == False and len(distance_heap) > 0:
 
-        min_distance_data = distance_data_sorted[0]
-        polys_to_connect = (min_distance_data[0], min_distance_data[1])
+        min_distance_data = distance_heap[0]
+        polys_to_connect = (min_distance_data[2], min_distance_data[3])
     
     # For each of the two polygons that we want to connect, identify the two 
     # vertices at the ends of their boundary segment.
@@ -649,20 +708,21 @@ def partial_fill_data_jc(hole0, hole_boundaries_df0):
 
     
         boundary_point_coords = []
-
-        vertices = [[], []]
+        vertices = []
         vertices_nearest_point_pairs = [[], []]
         vertices_distances = [[], []]
 
         for i in range(2):
-            boundary_point_coords.append([x for x in hole_boundaries_df["geometry"][polys_to_connect[i]].coords])
-            vertices[i].append(Point(boundary_point_coords[i][0][0], boundary_point_coords[i][0][1]))
-            vertices[i].append(Point(boundary_point_coords[i][-1][0], boundary_point_coords[i][-1][1]))
+            boundary_point_coords.append(boundary_coords[polys_to_connect[i]])
+            vertices.append(boundary_end_vertices[polys_to_connect[i]])
 
         for i in range(2):
+            # Squared distances from both end vertices to every vertex of the other boundary:
+            dist_sq = ((boundary_point_coords[1-i][None, :, :] - vertices[i][:, None, :])**2).sum(axis=2)
+            nearest = dist_sq.argmin(axis=1)
             for j in range(2):
-                vertices_nearest_point_pairs[i].append(shp.ops.nearest_points(vertices[i][j], MultiPoint(boundary_point_coords[1-i])))
-                vertices_distances[i].append(vertices_nearest_point_pairs[i][j][0].distance(vertices_nearest_point_pairs[i][j][1]))
+                vertices_nearest_point_pairs[i].append((vertices[i][j], boundary_point_coords[1-i][nearest[j]]))
+                vertices_distances[i].append(sqrt(dist_sq[j, nearest[j]]))
                     
                     
     # Identify the list positions of the two shortest of these four distances, and 
@@ -686,56 +746,64 @@ def partial_fill_data_jc(hole0, hole_boundaries_df0):
     # Ignore any of the line segments that aren't contained within the hole (but 
     # contained within the boundary is okay - and happens!):
     
-        sorted_line_segments = []
-        for k in range(4):
-            if hole.contains(sorted_line_segments_0[k]) or hole.boundary.contains(sorted_line_segments_0[k]):
-                sorted_line_segments.append(sorted_line_segments_0[k])
+        sorted_line_segments_0 = np.array(sorted_line_segments_0, dtype=object)
+        contained = shp.contains(hole, sorted_line_segments_0) | shp.contains(hole_boundary, sorted_line_segments_0)
+        sorted_line_segments = list(sorted_line_segments_0[contained])
 
 
         line_pair_found = False
         
         if len(sorted_line_segments) > 1:
-            for j in range(1, len(sorted_line_segments)):
-                for i in range(j):
-                    if sorted_line_segments[i].disjoint(sorted_line_segments[j]) and line_pair_found == False:
-                        line_pair = [i,j]
-                        line_pair_found = True
+            # Test all pairs at once, and take the first disjoint pair in (j, i) order:
+            pair_j, pair_i = np.tril_indices(len(sorted_line_segments), k=-1)
+            segments = np.array(sorted_line_segments, dtype=object)
+            disjoint_pairs = np.flatnonzero(shp.disjoint(segments[pair_i], segments[pair_j]))
+            if len(disjoint_pairs) > 0:
+                line_pair = [pair_i[disjoint_pairs[0]], pair_j[disjoint_pairs[0]]]
+                line_pair_found = True
                         
         
         if line_pair_found==True:
  
             new_holes = []
             
-            first_split = shp.ops.split(hole, sorted_line_segments[line_pair[0]])
+            first_line = sorted_line_segments[line_pair[0]]
+            second_line = sorted_line_segments[line_pair[1]]
+            shp.prepare(first_line)
+            shp.prepare(second_line)
+            
+            first_split = shp.ops.split(hole, first_line)
     
     # First_split should contain two pieces, one of which also intersects the second line.  
     # Find that piece, and split it with the second line. 
     
-            for k in range(len(first_split)): 
-                if first_split[k].intersects(sorted_line_segments[line_pair[1]]):
-                    second_split = shp.ops.split(first_split[k], sorted_line_segments[line_pair[1]])
+            for piece in first_split.geoms: 
+                if second_line.intersects(piece):
+                    second_split = shp.ops.split(piece, second_line)
                 else: 
-                    new_holes.append(first_split[k])
+                    new_holes.append(piece)
                  
     # Find the piece in second_split that also touches the first line.  
     # THIS WILL BE OUR PIECE TO ADJOIN TO ONE OF THE TWO POLYGONS!
 
     
-            for k in range(len(second_split)): 
-                if second_split[k].intersects(sorted_line_segments[line_pair[0]]):
-                    piece_to_connect = second_split[k]
+            for piece in second_split.geoms: 
+                if first_line.intersects(piece):
+                    piece_to_connect = piece
                     poly_pair_found = True  # SUCCESS!!
                 else:
-                    new_holes.append(second_split[k])
+                    new_holes.append(piece)
                 
         if poly_pair_found == True:
-            if piece_to_connect.intersection(hole_boundaries_df["geometry"][polys_to_connect[0]]).length > piece_to_connect.intersection(hole_boundaries_df["geometry"][polys_to_connect[1]]).length:
-                poly_to_add_to = hole_boundaries_df["target"][polys_to_connect[0]]
-            elif piece_to_connect.intersection(hole_boundaries_df["geometry"][polys_to_connect[0]]).length < piece_to_connect.intersection(hole_boundaries_df["geometry"][polys_to_connect[1]]).length:              
-                poly_to_add_to = hole_boundaries_df["target"][polys_to_connect[1]]
+            # Both intersection lengths in one call, straight from the boundary array:
+            connect_lengths = shp.length(shp.intersection(piece_to_connect, boundary_geoms[list(polys_to_connect)]))
+            if connect_lengths[0] > connect_lengths[1]:
+                poly_to_add_to = boundary_targets[polys_to_connect[0]]
+            elif connect_lengths[0] < connect_lengths[1]:              
+                poly_to_add_to = boundary_targets[polys_to_connect[1]]
    
         else: #Try again with a different polygon pair
-            distance_data_sorted.remove(distance_data_sorted[0]) 
+            heapq.heappop(distance_heap) 
                 
         
 
@@ -744,21 +812,24 @@ def partial_fill_data_jc(hole0, hole_boundaries_df0):
                                   # perimeter and hope for the best!  (Usually these will
                                   # be small enough that they'll get converted to queen
                                   # adjacencies eventually anyway.)
-        shared_perimeters = []
-                
-        for b_ind in hole_boundaries_df.index:
-            g_ind = hole_boundaries_df["target"][b_ind]
-            shared_perimeters.append((b_ind, hole_boundaries_df["geometry"][b_ind].length))
-                
-        max_shared_perim = sorted(shared_perimeters, key=lambda tup: tup[1])[-1]
-
-        poly_to_add_to = hole_boundaries_df["target"][max_shared_perim[0]]
+        # Last of any ties, as the old sorted(...)[-1] picked:
+        poly_to_add_to = boundary_targets[len(boundary_lengths) - 1 - np.argmax(boundary_lengths[::-1])]
         piece_to_connect = hole
         new_holes = []
         
+    if not hole_was_prepared:
+        shp.destroy_prepared(hole)
+        
     return poly_to_add_to, piece_to_connect, new_holes
  
 
+# Unit circle vertices for the disks below, in the same order as Point.buffer makes them
+# (64 segments, clockwise from angle 0), so we don't need to call buffer for every disk:
+
+_DISK_ANGLES = -np.linspace(0, 2*np.pi, 65)[:-1]
+_DISK_X, _DISK_Y = np.cos(_DISK_ANGLES), np.sin(_DISK_ANGLES)
+
+
 # Convert all rook adjacencies with boundary length less than min_rook_length to queen adjacencies
 
 def small_rook_to_queen_jc(geometries0_df, min_rook_length):
@@ -768,20 +839,24 @@ def small_rook_to_queen_jc(geometries0_df, min_rook_length):
     adj_df = adjacencies_jc(geometries_df)  # We're assuming the input is clean, so these should all be 1-D or less
 
 
-    for ind in adj_df.index:
-        if adj_df["geometry"][ind].geom_type == "GeometryCollection":
-            adj_list = list(adj_df["geometry"][ind])
-            adj_list_no_point = [x for x in adj_list if x.geom_type != "Point"]
-            adj_df["geometry"][ind] = MultiLineString(adj_list_no_point)
+    # Drop any points from GeometryCollections, leaving MultiLineStrings:
+    collections = (adj_df["geometry"].geom_type == "GeometryCollection").values
+    if collections.any():
+        parts, part_rows = shp.get_parts(adj_df["geometry"].values[collections], return_index=True)
+        is_line = shp.get_type_id(parts) == 1
+        no_points = np.full(collections.sum(), MultiLineString(), dtype=object)
+        shp.multilinestrings(parts[is_line], indices=part_rows[is_line], out=no_points)
+        adj_df.loc[collections, "geometry"] = no_points
                     
-        if adj_df["geometry"][ind].geom_type == "MultiLineString":
-            adj_df["geometry"][ind] = linemerge(adj_df["geometry"][ind])
+    multi_lines = (adj_df["geometry"].geom_type == "MultiLineString").values
+    adj_df.loc[multi_lines, "geometry"] = shp.line_merge(adj_df["geometry"].values[multi_lines])
+    
+    # Keep the full length of each adjacency, for checking below whether it still matters:
+    adj_df["total length"] = adj_df["geometry"].length
 
-    adj_df = adj_df.explode().reset_index(drop=True)
+    adj_df = adj_df.explode(index_parts=False).reset_index(drop=True)
 
-    for ind in adj_df.index:
-        if adj_df["geometry"][ind].geom_type == "Point":
-            adj_df = adj_df.drop(ind)
+    adj_df = adj_df[(adj_df["geometry"].geom_type != "Point").values]
     
     
     # Add column for boundary length and pick off the small ones:
@@ -790,109 +865,129 @@ def small_rook_to_queen_jc(geometries0_df, min_rook_length):
     
     small_adj_df = adj_df[adj_df["boundary length"] < min_rook_length]
     
+    # Work on a plain array of the geometries, by position, and write it back at the end:
+    geoms = geometries_df["geometry"].to_numpy().copy()
     
-    for a_ind in small_adj_df.index:
+    # Build the STRtree once.  Each fix only changes the geometries near one small
+    # adjacency, so rather than rebuilding the tree every time, keep track of which
+    # geometries have changed and check their current shapes separately.
+    g_spatial_index = STRtree(geoms) # Build STRtree for the main geometries
+    changed_indices = set()
+    
+    for this_adj, parent_indices, total_length in zip(small_adj_df["geometry"].values, small_adj_df["parent indices"], 
+                                                      small_adj_df["total length"].values):
                 
         # Make sure we haven't inadvertently killed off this adjacency while we were fixing others!
+        # (This can only have happened if one of its geometries has changed.)
         
-        geoms_for_this_adj = list(small_adj_df["parent indices"][a_ind])
-        adj_len = geometries_df["geometry"][geoms_for_this_adj[0]].intersection(geometries_df["geometry"][geoms_for_this_adj[1]]).length
+        geoms_for_this_adj = geometries_df.index.get_indexer(list(parent_indices))
+        if changed_indices.isdisjoint(geoms_for_this_adj):
+            adj_len = total_length
+        else:
+            adj_len = geoms[geoms_for_this_adj[0]].intersection(geoms[geoms_for_this_adj[1]]).length
         
         if adj_len > 0 and adj_len < min_rook_length:
         
-            # Rebuild the STRtree every time because the geometries will change every time.
-            g_spatial_index = STRtree(geometries_df["geometry"]) # Build STRtree for the main geometries
-            g_index_by_id = dict((id(geom), i) for i, geom in geometries_df["geometry"].items()) # Build indexing dictionary
-
             # Build a disk enclosing this adjacency; the idea will be to cut it out and replace it 
             # with a "pie chart" so that all polygons touching this disk meet at a queen adjacency 
             # point at the center of the disk.
-            adj_diam = small_adj_df["geometry"][a_ind].length
+            adj_diam = this_adj.length
             fat_point_radius = 0.6*adj_diam # slightly more than the radius from the midpoint to the endpoints
 
-            adjacency_points = [x for x in small_adj_df["geometry"][a_ind].coords]
+            adjacency_points = shp.get_coordinates(this_adj)
             endpoint1 = adjacency_points[0]
             endpoint2 = adjacency_points[-1]
             midpoint = LineString([endpoint1, endpoint2]).centroid
             midpoint_coords = midpoint.coords[0]
                     
-            disk_to_remove = midpoint.buffer(fat_point_radius)
+            disk_to_remove = Polygon(np.column_stack([midpoint_coords[0] + fat_point_radius*_DISK_X, 
+                                                      midpoint_coords[1] + fat_point_radius*_DISK_Y]))
  
             # Identify geometries that might intersect this disk.
-            possible_geom_indices = [
-                (g_index_by_id[id(geom)]) for geom in g_spatial_index.query(small_adj_df["geometry"][a_ind].buffer(2*fat_point_radius))]
+            search_area = this_adj.buffer(2*fat_point_radius)
+            shp.prepare(search_area)
+            # The tree only knows the original shapes, so it only answers for unchanged geometries.
+            possible_geom_indices = set(g_spatial_index.query(search_area, predicate="intersects")) - changed_indices
+            changed = np.array(sorted(changed_indices), dtype=int)
+            changed_near = shp.intersects(geoms[changed], search_area)
+            possible_geom_indices.update(changed[changed_near])
+            possible_geom_indices = sorted(possible_geom_indices)
+            old_possible_geoms = geoms[possible_geom_indices]
        
             # Use the boundaries of these geometries together with the boundary of the disk to 
             # polygonize and divide geometries into pieces inside and outside the disk
-            boundaries = [geometries_df["geometry"][i].boundary for i in possible_geom_indices]
-            boundaries.append(LineString(list(disk_to_remove.exterior.coords)))
+            boundaries = list(shp.boundary(geoms[possible_geom_indices]))
+            boundaries.append(LineString(shp.get_coordinates(disk_to_remove.exterior)))
         
-            boundaries_union = unary_union(boundaries) 
+            # Only the noding is needed here, not the full union (polygonize copes with the 
+            # duplicate edges that noding leaves behind).  shapely.node needs GEOS >= 3.11.
+            if shp.geos_version >= (3, 11, 0):
+                boundaries_union = shp.node(shp.multilinestrings(shp.get_parts(boundaries))) 
+            else:
+                boundaries_union = unary_union(boundaries) 
 
-            pieces_df = gpd.GeoDataFrame(columns = ["polygon indices"], 
-                                     geometry = gpd.GeoSeries([geom for geom in polygonize(boundaries_union)]),
-                                     crs = geometries_df.crs)
+            pieces = np.array([geom for geom in polygonize(boundaries_union)], dtype=object)
 
-            # Associate the pieces to the main geometries.  (Note that if there are holes, some pieces may
-            # be unassigned.)
-            for i in pieces_df.index:
-                pieces_df["polygon indices"][i] = set()
+            # Associate the pieces to the main geometries, in one pass over the tree query.  
+            # (Note that if there are holes, some pieces may be unassigned.)
+            possible_geoms_index = STRtree(geoms[possible_geom_indices])
+            rep_points = shp.point_on_surface(pieces)
+            piece_pos, geom_pos = possible_geoms_index.query(rep_points, predicate="intersects")
+            num_owners = np.bincount(piece_pos, minlength=len(pieces))
         
-            for i in pieces_df.index: 
-                temp_possible_geom_indices = [
-                    (g_index_by_id[id(geom)]) for geom in g_spatial_index.query(pieces_df["geometry"][i])
-                    ]            
-                for j in temp_possible_geom_indices:
-                    if pieces_df["geometry"][i].representative_point().distance(geometries_df["geometry"][j]) == 0:
-                        pieces_df["polygon indices"][i] = pieces_df["polygon indices"][i].union({j})
         
+            # Now rebuild the disk from the pieces that are inside the circle.  Then we'll give 
+            # the pieces outside the circle back to the geometries that they came from.
         
-            # Now rebuild the disk from the pieces that are inside the circle, and drop them from 
-            # pieces_df.  Then we'll give the pieces outside the circle back to the geometries that they came from.
+            inside_disk = shp.distance(rep_points, midpoint) < fat_point_radius
+            disk_to_remove = unary_union(list(pieces[inside_disk]))
         
-            disk_to_remove = Polygon()
-
-            for p_ind in pieces_df.index:
-                if pieces_df["geometry"][p_ind].representative_point().distance(midpoint) < fat_point_radius:
-                    disk_to_remove = unary_union([disk_to_remove, pieces_df["geometry"][p_ind]])
-                    pieces_df = pieces_df.drop(p_ind)
-        
-            for g_ind in possible_geom_indices:
-                geometries_df["geometry"][g_ind] = Polygon()
+            geoms[possible_geom_indices] = Polygon()
     
-            for p_ind in pieces_df.index:
-                if len(pieces_df["polygon indices"][p_ind]) == 1:  #Note that it won't be >1 if the file is clean!
-                    this_poly_ind = list(pieces_df["polygon indices"][p_ind])[0]
-                    this_piece = pieces_df["geometry"][p_ind]
-                    if this_poly_ind in possible_geom_indices: 
-                    # This check is needed because the geometries in possible_geom_incides can form a 
-                    # non-simply-connected region, in which case the interior holes - which may consist
-                    # of multiple precincts each - may be assigned someplace they shouldn't be!
-                        geometries_df["geometry"][this_poly_ind] = unary_union([geometries_df["geometry"][this_poly_ind], this_piece])
+            # Only pieces with exactly one owner get handed back (it won't be >1 if the file is clean!)
+            # Owners come only from possible_geom_indices, which matters because those geometries can 
+            # form a non-simply-connected region, in which case the interior holes - which may consist
+            # of multiple precincts each - could otherwise be assigned someplace they shouldn't be!
+            to_hand_back = (num_owners[piece_pos] == 1) & ~inside_disk[piece_pos]
+            pieces_by_geom = defaultdict(list)
+            for p_pos, this_poly_ind in zip(piece_pos[to_hand_back], np.array(possible_geom_indices)[geom_pos[to_hand_back]]):
+                pieces_by_geom[this_poly_ind].append(pieces[p_pos])
+            
+            # Union all the pieces for each geometry at once:
+            for this_poly_ind, these_pieces in pieces_by_geom.items():
+                geoms[this_poly_ind] = unary_union(these_pieces)
 
             # Find the boundary arcs between geometries and the disk (and make sure each arc is a connected piece):
-            possible_geoms = geometries_df.loc[possible_geom_indices]
+            possible_geoms = gpd.GeoDataFrame(geometry = gpd.GeoSeries(geoms[possible_geom_indices], index = possible_geom_indices, crs = geometries_df.crs))
             circle_boundaries_df = intersections_jc(gpd.GeoDataFrame(geometry = gpd.GeoSeries([disk_to_remove], crs = geometries_df.crs)), possible_geoms) 
         
-            for b_ind in circle_boundaries_df.index:
-                if circle_boundaries_df["geometry"][b_ind].geom_type == "MultiLineString":
-                    circle_boundaries_df["geometry"][b_ind] = linemerge(circle_boundaries_df["geometry"][b_ind])
+            multi_lines = (circle_boundaries_df["geometry"].geom_type == "MultiLineString").values
+            circle_boundaries_df.loc[multi_lines, "geometry"] = shp.line_merge(circle_boundaries_df["geometry"].values[multi_lines])
 
-            circle_boundaries_df = circle_boundaries_df.explode().reset_index(drop=True)    
+            circle_boundaries_df = circle_boundaries_df.explode(index_parts=False).reset_index(drop=True)    
         
-            # For each boundary arc, create a "pie wedge" from the center of the disk subtending this arc:
+            # For each boundary arc, create a "pie wedge" from the center of the disk subtending this arc.
+            # Build the rings for all the wedges at once, by adding the center after each arc's vertices:
         
-            for b_ind in circle_boundaries_df.index:
-                boundary_arc_coords = [x for x in circle_boundaries_df["geometry"][b_ind].coords]
-                boundary_wedge_coords = boundary_arc_coords + [midpoint_coords]
-    
-                g_ind = circle_boundaries_df["target"][b_ind]
+            num_arcs = len(circle_boundaries_df)
+            arc_coords, arc_rows = shp.get_coordinates(circle_boundaries_df["geometry"].values, return_index=True)
+            wedge_coords = np.concatenate([arc_coords, np.tile(midpoint_coords, (num_arcs, 1))])
+            wedge_rows = np.concatenate([arc_rows, np.arange(num_arcs)])
+            wedge_order = np.argsort(wedge_rows, kind="stable")
+            wedges = shp.polygons(shp.linearrings(wedge_coords[wedge_order], indices=wedge_rows[wedge_order]))
 
-                geometries_df["geometry"][g_ind] = unary_union([geometries_df["geometry"][g_ind], Polygon(boundary_wedge_coords)])
+            wedges_by_geom = defaultdict(list)
+            for this_wedge, g_ind in zip(wedges, circle_boundaries_df["target"]):
+                wedges_by_geom[g_ind].append(this_wedge)
+            
+            # Then add all the wedges for each geometry at once:
+            for g_ind, these_wedges in wedges_by_geom.items():
+                geoms[g_ind] = unary_union([geoms[g_ind]] + these_wedges)
+            
+            # Everything nearby got cut up and rebuilt, but only keep track of the ones that came out different:
+            replaced = ~shp.equals(geoms[possible_geom_indices], old_possible_geoms)
+            changed_indices.update(np.array(possible_geom_indices)[replaced])
         
+    geometries_df["geometry"] = gpd.GeoSeries(geoms, index = geometries_df.index, crs = geometries_df.crs)
                 
     return geometries_df
-    
-
-
-